@@ -6,15 +6,19 @@ Handles provisioning and management of OpenClaw agent containers
 
 import os
 import json
+import math
 import uuid
 import secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from functools import wraps
 
 import docker
 import redis
 import requests
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g, has_request_context
 
 app = Flask(__name__)
 
@@ -22,14 +26,312 @@ app = Flask(__name__)
 LITELLM_BASE_URL = os.environ.get("LITELLM_BASE_URL", "http://litellm:4000")
 LITELLM_MASTER_KEY = os.environ.get("LITELLM_MASTER_KEY", "sk-theone-master-2026")
 REDIS_URL = os.environ.get("REDIS_URL", "redis://redis:6379")
+REDIS_CLUSTER = os.environ.get("REDIS_CLUSTER", "false").lower() == "true"
 API_SECRET = os.environ.get("API_SECRET", "theone-orchestrator-secret-2026")
 AGENTS_DIR = "/opt/theone/agents"
+# Default agent image; once a rollout completes, the fleet image in Redis wins
+PLACEHOLDER_IMAGE = "python:3.12-slim"
+AGENT_IMAGE = os.environ.get("AGENT_IMAGE", PLACEHOLDER_IMAGE)  # Placeholder - replace with openclaw image
+# Command override for agent containers; unset runs the image's own entrypoint
+# (the placeholder image has none that stays up, so it gets "sleep infinity")
+AGENT_COMMAND = os.environ.get("AGENT_COMMAND")
+# How long a recreated agent must stay running (and healthy, if the image
+# defines a HEALTHCHECK) before a rollout counts it as updated
+AGENT_START_GRACE = float(os.environ.get("AGENT_START_GRACE", "10"))
+AGENT_HEALTH_TIMEOUT = float(os.environ.get("AGENT_HEALTH_TIMEOUT", "60"))
+# Extra Docker hosts to pre-pull images on during rollouts (comma separated base URLs)
+DOCKER_NODES = [url for url in os.environ.get("DOCKER_NODES", "").split(",") if url]
+# Agents recreated in parallel per rollout wave, at most
+MAX_ROLLOUT_WAVE_SIZE = int(os.environ.get("MAX_ROLLOUT_WAVE_SIZE", "20"))
+# The active-rollout lock expires this long after its worker stops refreshing
+# it (e.g. the orchestrator restarted mid-rollout)
+ROLLOUT_LOCK_TTL = int(os.environ.get("ROLLOUT_LOCK_TTL", "60"))
+# Env vars set by the orchestrator on agent containers, carried over on recreate
+AGENT_ENV_KEYS = ("AGENT_ID", "USER_ID", "LITELLM_BASE_URL", "LITELLM_API_KEY", "ANTHROPIC_API_KEY")
+HOURLY_LIMIT = 200000  # 200K tokens per hour
+
+# Usage rollups: resolution -> (bucket size seconds, retention seconds)
+ROLLUP_RESOLUTIONS = {
+    "minute": (60, 24 * 3600),         # 24 hours of minute buckets
+    "hour": (3600, 31 * 86400),        # 31 days of hour buckets
+    "day": (86400, 400 * 86400),       # ~13 months of day buckets
+}
+ROLLUP_MAX_BUCKETS = 1500  # Max buckets returned by one range query
+ROLLUP_FIELDS = ("cents", "tokens", "calls")
+
+# Timeouts (seconds) for calls into Redis, Docker and HTTP services.
+# Request paths also cap Redis timeouts by the time left before their deadline.
+REDIS_TIMEOUT = float(os.environ.get("REDIS_TIMEOUT", "0.5"))  # Fast-path (billing) calls
+REDIS_SLOW_TIMEOUT = float(os.environ.get("REDIS_SLOW_TIMEOUT", "5"))  # Slow-path and batch calls
+REDIS_BACKGROUND_TIMEOUT = float(os.environ.get("REDIS_BACKGROUND_TIMEOUT", "10"))  # Rollouts, migrations
+DOCKER_TIMEOUT = int(os.environ.get("DOCKER_TIMEOUT", "60"))
+DOCKER_BUILD_TIMEOUT = int(os.environ.get("DOCKER_BUILD_TIMEOUT", "900"))
+HTTP_TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", "30"))
+# Billing checks when Redis times out: "open" allows the call, "closed" denies it
+BILLING_FAILURE_POLICY = os.environ.get("BILLING_FAILURE_POLICY", "open").lower()
+if BILLING_FAILURE_POLICY not in ("open", "closed"):
+    raise ValueError(f"BILLING_FAILURE_POLICY must be 'open' or 'closed', got {BILLING_FAILURE_POLICY!r}")
+# How long a deduction's charge_id is remembered to make callback retries safe
+CHARGE_DEDUPE_TTL = 24 * 3600
 
 # Initialize Docker client
-docker_client = docker.from_env()
+# Background work uses docker_client; request handlers use request_docker()
+docker_client = docker.from_env(timeout=DOCKER_TIMEOUT)
 
 # Initialize Redis
-redis_client = redis.from_url(REDIS_URL)
+def connect_redis(timeout, read_from_replicas=False):
+    """
+    Connect to Redis, either a single instance or a Redis Cluster
+    (REDIS_CLUSTER=true, REDIS_URL pointing at any node of the cluster)
+    """
+    timeouts = {"socket_timeout": timeout, "socket_connect_timeout": timeout}
+    if REDIS_CLUSTER:
+        from redis.cluster import RedisCluster
+        return RedisCluster.from_url(REDIS_URL, read_from_replicas=read_from_replicas, **timeouts)
+    return redis.from_url(REDIS_URL, **timeouts)
+
+
+class LazyRedis:
+    """
+    Redis client that connects on first use. RedisCluster discovers the
+    cluster topology in its constructor, so connecting at import would keep
+    the orchestrator from starting while the cluster is down.
+    """
+
+    def __init__(self, connect):
+        self._connect = connect
+        self._client = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._connect()
+        return getattr(self._client, name)
+
+    def get_encoder(self):
+        # Lets scripts be registered (and hashed) without connecting
+        return redis.connection.Encoder("utf-8", "strict", False)
+
+    def register_script(self, script):
+        return redis.commands.core.Script(self, script)
+
+
+# Background work (rollouts, migrations) outside any request deadline.
+# Request handlers use request_redis() instead.
+redis_client = LazyRedis(lambda: connect_redis(REDIS_BACKGROUND_TIMEOUT))
+
+# Timeouts, lost connections and unreachable clusters, as opposed to errors
+# in the command itself
+REDIS_UNAVAILABLE_ERRORS = (
+    redis.exceptions.TimeoutError,
+    redis.exceptions.ConnectionError,
+    redis.exceptions.RedisClusterException,
+    redis.exceptions.ClusterDownError
+)
+
+_redis_clients = {}
+_redis_clients_lock = threading.Lock()
+
+
+def redis_with_timeout(timeout, read_from_replicas=False):
+    """
+    Redis client with the given socket timeout. Timeouts are rounded up to
+    0.1s below one second and down to whole seconds above, and one client
+    (with its own connection pool) is kept per value. Status queries can
+    tolerate slightly stale data, so read_from_replicas lets cluster replicas
+    serve them; billing paths always read primaries.
+    """
+    timeout = math.ceil(timeout * 10) / 10 if timeout < 1 else math.floor(timeout)
+    key = (timeout, read_from_replicas and REDIS_CLUSTER)
+    with _redis_clients_lock:
+        client = _redis_clients.get(key)
+    if client is None:
+        # Cluster discovery happens here; don't hold up other requests for it
+        client = connect_redis(timeout, read_from_replicas=key[1])
+        with _redis_clients_lock:
+            client = _redis_clients.setdefault(key, client)
+    return client
+
+
+_docker_clients = {DOCKER_TIMEOUT: docker_client}
+_docker_clients_lock = threading.Lock()
+
+
+def docker_with_timeout(timeout):
+    """
+    Docker client with the given API timeout. Timeouts are rounded up to
+    whole seconds below 10s and down to tens of seconds above, and one
+    client is kept per value.
+    """
+    timeout = math.ceil(timeout) if timeout < 10 else int(timeout // 10 * 10)
+    with _docker_clients_lock:
+        client = _docker_clients.get(timeout)
+    if client is None:
+        client = docker.from_env(timeout=timeout, version=docker_client.api.api_version)
+        with _docker_clients_lock:
+            client = _docker_clients.setdefault(timeout, client)
+    return client
+
+
+# Redis keys. Per-user keys wrap the user_id in a {hash tag} so that all of
+# a user's keys map to the same cluster slot and can be used together in
+# a single Lua script or MULTI.
+def credits_key(user_id):
+    return f"credits:{{{user_id}}}"
+
+
+def rate_key(user_id):
+    return f"rate:{{{user_id}}}:hourly"
+
+
+def charge_key(user_id, charge_id):
+    return f"charge:{{{user_id}}}:{charge_id}"
+
+
+def agent_key(agent_id):
+    return f"agent:{agent_id}"
+
+
+MIGRATION_KEY = "migrations:hash_tagged_user_keys"
+
+
+def migrate_legacy_user_keys():
+    """
+    One-time move of per-user keys from their pre-hash-tag names
+    (credits:<id>, rate:<id>:hourly) so balances survive the rename.
+    Idempotent; MIGRATION_KEY is only set once every key has moved.
+    """
+    if redis_client.exists(MIGRATION_KEY):
+        return
+
+    moved = 0
+    for prefix, suffix, new_key in (("credits:", "", credits_key), ("rate:", ":hourly", rate_key)):
+        for old_key in redis_client.scan_iter(match=f"{prefix}*{suffix}"):
+            old_key = old_key.decode()
+            if old_key.startswith(prefix + "{"):
+                continue
+            user_id = old_key[len(prefix):len(old_key) - len(suffix)]
+            value = redis_client.get(old_key)
+            ttl = redis_client.pttl(old_key)
+            if value is not None:
+                # Never overwrite a balance already written under the new name
+                redis_client.set(new_key(user_id), value, nx=True, px=ttl if ttl > 0 else None)
+            redis_client.delete(old_key)
+            moved += 1
+
+    redis_client.set(MIGRATION_KEY, datetime.utcnow().isoformat())
+    app.logger.info("Migrated %d legacy per-user keys to hash-tagged names", moved)
+
+
+FLEET_IMAGE_KEY = "fleet:agent_image"
+ACTIVE_ROLLOUT_KEY = "fleet:rollout:active"
+ROLLOUT_FINAL_STATUSES = ("completed", "halted", "failed")
+
+
+def rollout_key(rollout_id):
+    return f"rollout:{{{rollout_id}}}"
+
+
+def rollout_agents_key(rollout_id):
+    return f"rollout:{{{rollout_id}}}:agents"
+
+
+def rollup_key(scope, scope_id, resolution, bucket_start):
+    """
+    Usage rollup bucket, a hash of ROLLUP_FIELDS counters.
+    User buckets share the user's hash tag; agent buckets get their own.
+    """
+    if scope == "user":
+        return f"usage:{{{scope_id}}}:{resolution}:{bucket_start}"
+    return f"usage:agent:{{{scope_id}}}:{resolution}:{bucket_start}"
+
+
+def record_usage(user_id, agent_id=None, cents=0, tokens=0, calls=0):
+    """
+    Add usage to the minute/hour/day rollups of a user (and agent).
+    Every resolution is updated on write, so reads never aggregate raw
+    events. Buckets expire once they fall out of their retention window.
+    """
+    now = int(time.time())
+    counters = {"cents": cents, "tokens": tokens, "calls": calls}
+    scopes = [("user", user_id)]
+    if agent_id:
+        scopes.append(("agent", agent_id))
+
+    pipe = request_redis().pipeline(transaction=False)
+    for scope, scope_id in scopes:
+        for resolution, (size, retention) in ROLLUP_RESOLUTIONS.items():
+            key = rollup_key(scope, scope_id, resolution, now - now % size)
+            for field, amount in counters.items():
+                if amount:
+                    pipe.hincrby(key, field, amount)
+            pipe.expire(key, retention + size)
+    try:
+        pipe.execute()
+    except REDIS_UNAVAILABLE_ERRORS as e:
+        # Rollups are best effort; the balance/rate update already happened
+        app.logger.warning("Dropped usage rollup for %s: %s", user_id, e)
+
+
+# Atomic credit + rate-limit check for one LLM call.
+# KEYS: credits key, rate key (same hash tag)
+# ARGV: estimated cents, requested tokens, hourly limit, window seconds
+# Returns: {allowed, reason, balance cached (0/1), balance_cents, current_tokens}
+USAGE_CHECK_SCRIPT = redis_client.register_script("""
+local balance = redis.call('GET', KEYS[1])
+local current = tonumber(redis.call('GET', KEYS[2]) or '0')
+local cached = 0
+local balance_cents = 0
+if balance then
+    cached = 1
+    balance_cents = tonumber(balance)
+    if balance_cents < tonumber(ARGV[1]) then
+        return {0, 'insufficient_credits', cached, balance_cents, current}
+    end
+end
+if current + tonumber(ARGV[2]) > tonumber(ARGV[3]) then
+    return {0, 'rate_limited', cached, balance_cents, current}
+end
+current = redis.call('INCRBY', KEYS[2], ARGV[2])
+redis.call('EXPIRE', KEYS[2], ARGV[4])
+return {1, 'ok', cached, balance_cents, current}
+""")
+
+# Idempotent deduction for one completed LLM call.
+# KEYS: credits key, charge dedupe key (same hash tag)
+# ARGV: cents, dedupe TTL seconds
+# Returns: {applied (0 if this charge_id was already deducted), balance_cents}
+DEDUCT_SCRIPT = redis_client.register_script("""
+if redis.call('SET', KEYS[2], ARGV[1], 'NX', 'EX', ARGV[2]) then
+    return {1, redis.call('DECRBY', KEYS[1], ARGV[1])}
+end
+return {0, tonumber(redis.call('GET', KEYS[1]) or '0')}
+""")
+
+# Compare-and-set for the active-rollout lock, so a worker only refreshes or
+# releases the lock it holds.
+# KEYS: lock key
+# ARGV: rollout id, TTL seconds (0 to release)
+# Returns: 1 if the lock was held by this rollout
+ROLLOUT_LOCK_SCRIPT = redis_client.register_script("""
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+if tonumber(ARGV[2]) > 0 then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+else
+    redis.call('DEL', KEYS[1])
+end
+return 1
+""")
+
+try:
+    migrate_legacy_user_keys()
+except REDIS_UNAVAILABLE_ERRORS as e:
+    # Retried on the next start; MIGRATION_KEY is not set until it completes
+    app.logger.warning("Legacy key migration skipped, Redis unavailable: %s", e)
 
 
 def require_auth(f):
@@ -43,6 +345,190 @@ def require_auth(f):
     return decorated
 
 
+class Bulkhead:
+    """
+    Bounded execution pool for one class of endpoints (used as a decorator).
+    At most `limit` requests run at once and at most `max_queue` wait up to
+    `queue_timeout` for a slot; anything beyond that is shed with a 503 and
+    Retry-After. Each admitted request gets a deadline of `deadline` seconds
+    from arrival, see time_left(), and Redis calls capped at `redis_timeout`,
+    see request_redis(). A request that runs out of time gets a 504.
+    """
+
+    def __init__(self, name, limit, max_queue, queue_timeout, deadline, retry_after, redis_timeout):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.deadline = deadline
+        self.retry_after = retry_after
+        self.redis_timeout = redis_timeout
+        self._slots = threading.BoundedSemaphore(limit)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.queued = 0
+        self.shed = 0
+        self.completed = 0
+
+    def __call__(self, f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            g.deadline = time.monotonic() + self.deadline
+            g.redis_timeout = self.redis_timeout
+            if not self._acquire():
+                return jsonify({
+                    "error": "Server busy, retry later",
+                    "pool": self.name
+                }), 503, {"Retry-After": str(self.retry_after)}
+            try:
+                response = f(*args, **kwargs)
+            except DeadlineExceeded:
+                response = None
+            finally:
+                with self._lock:
+                    self.in_flight -= 1
+                    self.completed += 1
+                self._slots.release()
+
+            # Handlers may have turned DeadlineExceeded into a generic 500
+            if g.get("deadline_exceeded"):
+                return jsonify({"error": "Request deadline exceeded", "pool": self.name}), 504
+            return response
+        return decorated
+
+    def _acquire(self):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                if self.queued >= self.max_queue:
+                    self.shed += 1
+                    return False
+                self.queued += 1
+            acquired = self._slots.acquire(timeout=self.queue_timeout)
+            with self._lock:
+                self.queued -= 1
+                if not acquired:
+                    self.shed += 1
+                    return False
+        with self._lock:
+            self.in_flight += 1
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                "limit": self.limit,
+                "in_flight": self.in_flight,
+                "queued": self.queued,
+                "max_queue": self.max_queue,
+                "shed": self.shed,
+                "completed": self.completed
+            }
+
+
+def pool_config(name, limit, max_queue, queue_timeout, deadline, retry_after, redis_timeout):
+    """Bulkhead with defaults overridable via <NAME>_POOL_* env vars"""
+    prefix = f"{name.upper()}_POOL_"
+    return Bulkhead(
+        name,
+        limit=int(os.environ.get(prefix + "LIMIT", limit)),
+        max_queue=int(os.environ.get(prefix + "MAX_QUEUE", max_queue)),
+        queue_timeout=float(os.environ.get(prefix + "QUEUE_TIMEOUT", queue_timeout)),
+        deadline=float(os.environ.get(prefix + "DEADLINE", deadline)),
+        retry_after=int(os.environ.get(prefix + "RETRY_AFTER", retry_after)),
+        redis_timeout=redis_timeout
+    )
+
+
+# Latency-critical LiteLLM hooks never wait behind Docker work
+fast_path = pool_config("fast", limit=64, max_queue=256, queue_timeout=0.2, deadline=2, retry_after=1,
+                        redis_timeout=REDIS_TIMEOUT)
+# Redis-only dashboard queries and bulk syncs, heavier than the billing hooks
+batch_path = pool_config("batch", limit=8, max_queue=32, queue_timeout=5, deadline=30, retry_after=5,
+                         redis_timeout=REDIS_SLOW_TIMEOUT)
+# Docker calls: container lifecycle, status and other multi-second operations
+slow_path = pool_config("slow", limit=4, max_queue=16, queue_timeout=10, deadline=120, retry_after=15,
+                        redis_timeout=REDIS_SLOW_TIMEOUT)
+# Image builds, one at a time
+build_path = pool_config("build", limit=1, max_queue=0, queue_timeout=0, deadline=900, retry_after=60,
+                         redis_timeout=REDIS_SLOW_TIMEOUT)
+POOLS = (fast_path, batch_path, slow_path, build_path)
+
+
+class Counters:
+    """Named counters for /api/metrics, safe to bump from any request thread"""
+
+    def __init__(self, *names):
+        self._lock = threading.Lock()
+        self._values = dict.fromkeys(names, 0)
+
+    def incr(self, name):
+        with self._lock:
+            self._values[name] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+
+counters = Counters("billing_redis_failures")
+
+
+def note_billing_redis_failure(error):
+    counters.incr("billing_redis_failures")
+    app.logger.warning("Billing Redis call failed (policy %s): %s", BILLING_FAILURE_POLICY, error)
+
+
+class DeadlineExceeded(Exception):
+    """The current request has no time left for another Redis, Docker or HTTP call"""
+
+
+def time_left(cap):
+    """
+    Seconds until the current request's deadline, capped at `cap`.
+    Raises DeadlineExceeded once the deadline has passed.
+    """
+    remaining = g.deadline - time.monotonic()
+    if remaining <= 0:
+        g.deadline_exceeded = True
+        raise DeadlineExceeded("request deadline exceeded")
+    return min(cap, remaining)
+
+
+def request_redis(read_from_replicas=False):
+    """Redis client whose timeout fits the current request's remaining deadline"""
+    return redis_with_timeout(time_left(g.redis_timeout), read_from_replicas)
+
+
+def request_docker(cap=DOCKER_TIMEOUT):
+    """
+    Docker client whose timeout fits the current request's remaining
+    deadline; outside a pooled request (e.g. rollouts) the shared client
+    """
+    if not has_request_context() or "deadline" not in g:
+        return docker_client
+    return docker_with_timeout(time_left(cap))
+
+
+def billing_check(f):
+    """
+    Apply BILLING_FAILURE_POLICY to a pre-call billing check when Redis
+    times out or is unreachable, rather than failing the LLM call with a 500
+    """
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        try:
+            return f(*args, **kwargs)
+        except REDIS_UNAVAILABLE_ERRORS + (DeadlineExceeded,) as e:
+            g.pop("deadline_exceeded", None)
+            note_billing_redis_failure(e)
+            return jsonify({
+                "allowed": BILLING_FAILURE_POLICY == "open",
+                "degraded": True,
+                "message": "Billing store unavailable"
+            })
+    return decorated
+
+
 @app.route("/health", methods=["GET"])
 def health():
     """Health check endpoint"""
@@ -51,13 +537,26 @@ def health():
         "timestamp": datetime.utcnow().isoformat(),
         "services": {
             "docker": "connected",
-            "redis": "connected" if redis_client.ping() else "disconnected"
-        }
+            "redis": "connected" if redis_with_timeout(REDIS_TIMEOUT).ping() else "disconnected"
+        },
+        "redis_mode": "cluster" if REDIS_CLUSTER else "standalone"
+    })
+
+
+@app.route("/api/metrics", methods=["GET"])
+@require_auth
+def metrics():
+    """Queue depth, in-flight and shed counts per execution pool"""
+    return jsonify({
+        "pools": {pool.name: pool.stats() for pool in POOLS},
+        **counters.snapshot(),
+        "billing_failure_policy": BILLING_FAILURE_POLICY
     })
 
 
 @app.route("/api/virtual-keys", methods=["POST"])
 @require_auth
+@slow_path
 def create_virtual_key():
     """
     Create a LiteLLM virtual key for a user
@@ -84,7 +583,8 @@ def create_virtual_key():
                     "created_by": "theone-orchestrator",
                     "created_at": datetime.utcnow().isoformat()
                 }
-            }
+            },
+            timeout=time_left(HTTP_TIMEOUT)
         )
 
         if response.status_code == 200:
@@ -105,8 +605,43 @@ def create_virtual_key():
         return jsonify({"error": str(e)}), 500
 
 
+def current_agent_image():
+    """Image new agents run: the last rolled-out image, or AGENT_IMAGE"""
+    image = request_redis().get(FLEET_IMAGE_KEY)
+    return image.decode() if image else AGENT_IMAGE
+
+
+def run_agent_container(image, agent_id, container_name, network_name, environment):
+    """Start an agent container with its agent directory mounted at /agent"""
+    agent_dir = os.path.join(AGENTS_DIR, agent_id)
+
+    command = AGENT_COMMAND
+    if command is None and image == PLACEHOLDER_IMAGE:
+        command = "sleep infinity"  # Keep placeholder container running
+
+    container = request_docker().containers.run(
+        image,
+        name=container_name,
+        detach=True,
+        environment=environment,
+        volumes={
+            agent_dir: {"bind": "/agent", "mode": "rw"}
+        },
+        network=network_name,
+        command=command,
+        restart_policy={"Name": "unless-stopped"}
+    )
+
+    # Connect to theone-network so it can reach LiteLLM
+    theone_network = request_docker().networks.get("theone_theone-network")
+    theone_network.connect(container)
+
+    return container
+
+
 @app.route("/api/agents/provision", methods=["POST"])
 @require_auth
+@slow_path
 def provision_agent():
     """
     Provision a new OpenClaw agent container for a user
@@ -127,14 +662,14 @@ def provision_agent():
     try:
         # Create isolated network for this agent
         try:
-            network = docker_client.networks.create(
+            network = request_docker().networks.create(
                 network_name,
                 driver="bridge",
                 internal=False  # Allow outbound for API calls
             )
         except docker.errors.APIError as e:
             if "already exists" in str(e):
-                network = docker_client.networks.get(network_name)
+                network = request_docker().networks.get(network_name)
             else:
                 raise
 
@@ -159,37 +694,22 @@ def provision_agent():
         with open(config_path, "w") as f:
             json.dump(config, f, indent=2)
 
-        # For now, create a simple container that can be used for testing
-        # In production, this would run the actual OpenClaw image
-        container = docker_client.containers.run(
-            "python:3.12-slim",  # Placeholder - replace with openclaw image
-            name=container_name,
-            detach=True,
-            environment={
-                "AGENT_ID": agent_id,
-                "USER_ID": user_id,
-                "LITELLM_BASE_URL": LITELLM_BASE_URL,
-                "LITELLM_API_KEY": virtual_key or LITELLM_MASTER_KEY,
-                "ANTHROPIC_API_KEY": virtual_key or "",  # OpenClaw uses this
-            },
-            volumes={
-                agent_dir: {"bind": "/agent", "mode": "rw"}
-            },
-            network=network_name,
-            command="sleep infinity",  # Keep container running
-            restart_policy={"Name": "unless-stopped"}
-        )
-
-        # Connect to theone-network so it can reach LiteLLM
-        theone_network = docker_client.networks.get("theone_theone-network")
-        theone_network.connect(container)
+        image = current_agent_image()
+        container = run_agent_container(image, agent_id, container_name, network_name, {
+            "AGENT_ID": agent_id,
+            "USER_ID": user_id,
+            "LITELLM_BASE_URL": LITELLM_BASE_URL,
+            "LITELLM_API_KEY": virtual_key or LITELLM_MASTER_KEY,
+            "ANTHROPIC_API_KEY": virtual_key or "",  # OpenClaw uses this
+        })
 
         # Store agent info in Redis
-        redis_client.hset(f"agent:{agent_id}", mapping={
+        request_redis().hset(agent_key(agent_id), mapping={
             "container_id": container.id,
             "container_name": container_name,
             "network_name": network_name,
             "user_id": user_id,
+            "image": image,
             "status": "running",
             "created_at": datetime.utcnow().isoformat()
         })
@@ -208,13 +728,14 @@ def provision_agent():
 
 @app.route("/api/agents/<agent_id>/deprovision", methods=["POST"])
 @require_auth
+@slow_path
 def deprovision_agent(agent_id):
     """
     Deprovision an agent container
     """
     try:
         # Get agent info from Redis
-        agent_info = redis_client.hgetall(f"agent:{agent_id}")
+        agent_info = request_redis().hgetall(agent_key(agent_id))
 
         if not agent_info:
             return jsonify({"error": "Agent not found"}), 404
@@ -224,21 +745,21 @@ def deprovision_agent(agent_id):
 
         # Stop and remove container
         try:
-            container = docker_client.containers.get(container_name)
-            container.stop(timeout=10)
+            container = request_docker().containers.get(container_name)
+            container.stop(timeout=math.ceil(time_left(10)))
             container.remove()
         except docker.errors.NotFound:
             pass
 
         # Remove network
         try:
-            network = docker_client.networks.get(network_name)
+            network = request_docker().networks.get(network_name)
             network.remove()
         except docker.errors.NotFound:
             pass
 
         # Update Redis
-        redis_client.hset(f"agent:{agent_id}", "status", "stopped")
+        request_redis().hset(agent_key(agent_id), "status", "stopped")
 
         return jsonify({
             "success": True,
@@ -252,18 +773,19 @@ def deprovision_agent(agent_id):
 
 @app.route("/api/agents/<agent_id>/pause", methods=["POST"])
 @require_auth
+@slow_path
 def pause_agent(agent_id):
     """Pause an agent container"""
     try:
-        agent_info = redis_client.hgetall(f"agent:{agent_id}")
+        agent_info = request_redis().hgetall(agent_key(agent_id))
         if not agent_info:
             return jsonify({"error": "Agent not found"}), 404
 
         container_name = agent_info.get(b"container_name", b"").decode()
-        container = docker_client.containers.get(container_name)
+        container = request_docker().containers.get(container_name)
         container.pause()
 
-        redis_client.hset(f"agent:{agent_id}", "status", "paused")
+        request_redis().hset(agent_key(agent_id), "status", "paused")
 
         return jsonify({"success": True, "status": "paused"})
     except Exception as e:
@@ -272,18 +794,19 @@ def pause_agent(agent_id):
 
 @app.route("/api/agents/<agent_id>/resume", methods=["POST"])
 @require_auth
+@slow_path
 def resume_agent(agent_id):
     """Resume a paused agent container"""
     try:
-        agent_info = redis_client.hgetall(f"agent:{agent_id}")
+        agent_info = request_redis().hgetall(agent_key(agent_id))
         if not agent_info:
             return jsonify({"error": "Agent not found"}), 404
 
         container_name = agent_info.get(b"container_name", b"").decode()
-        container = docker_client.containers.get(container_name)
+        container = request_docker().containers.get(container_name)
         container.unpause()
 
-        redis_client.hset(f"agent:{agent_id}", "status", "running")
+        request_redis().hset(agent_key(agent_id), "status", "running")
 
         return jsonify({"success": True, "status": "running"})
     except Exception as e:
@@ -292,17 +815,21 @@ def resume_agent(agent_id):
 
 @app.route("/api/agents/<agent_id>/status", methods=["GET"])
 @require_auth
+@slow_path
 def get_agent_status(agent_id):
     """Get agent container status"""
     try:
-        agent_info = redis_client.hgetall(f"agent:{agent_id}")
+        agent_info = request_redis(read_from_replicas=True).hgetall(agent_key(agent_id))
+        if not agent_info:
+            # A replica may not have caught up with a just-provisioned agent
+            agent_info = request_redis().hgetall(agent_key(agent_id))
         if not agent_info:
             return jsonify({"error": "Agent not found"}), 404
 
         container_name = agent_info.get(b"container_name", b"").decode()
 
         try:
-            container = docker_client.containers.get(container_name)
+            container = request_docker().containers.get(container_name)
             container_status = container.status
         except docker.errors.NotFound:
             container_status = "not_found"
@@ -318,8 +845,308 @@ def get_agent_status(agent_id):
         return jsonify({"error": str(e)}), 500
 
 
+def wait_until_started(container):
+    """
+    Raise unless `container` stays running for AGENT_START_GRACE seconds
+    and, if its image has a HEALTHCHECK, reports healthy in time.
+    Returns the time.monotonic() at which it was first seen serving
+    (running, and healthy if it has a health check).
+    """
+    started = time.monotonic()
+    up_at = None
+    while True:
+        container.reload()
+        state = container.attrs["State"]
+        if container.status != "running" or container.attrs.get("RestartCount", 0) > 0:
+            raise RuntimeError(f"Container {container.status} (exit code {state.get('ExitCode')})")
+
+        health = state.get("Health", {}).get("Status")
+        if health == "unhealthy":
+            raise RuntimeError("Container health check failed")
+        if up_at is None and health in (None, "healthy"):
+            up_at = time.monotonic()
+        elapsed = time.monotonic() - started
+        if elapsed >= AGENT_START_GRACE and health in (None, "healthy"):
+            return up_at
+        if elapsed >= AGENT_HEALTH_TIMEOUT:
+            raise RuntimeError(f"Container not healthy after {AGENT_HEALTH_TIMEOUT:.0f}s")
+        time.sleep(1)
+
+
+def recreate_agent(agent_id, image):
+    """
+    Replace an agent's container with one running `image`, keeping its
+    agent directory, network and orchestrator-set env (incl. virtual key).
+    If the new container fails to start or crashes within the grace period,
+    the agent is brought back on its previous image.
+    Returns a per-agent rollout result including downtime, measured from
+    stopping the old container until the new one was first seen serving.
+    """
+    agent_info = redis_client.hgetall(agent_key(agent_id))
+    container_name = agent_info.get(b"container_name", b"").decode()
+    network_name = agent_info.get(b"network_name", b"").decode()
+
+    old = docker_client.containers.get(container_name)
+    old_image = old.attrs["Config"]["Image"]
+    environment = {}
+    for entry in old.attrs["Config"].get("Env") or []:
+        name, _, value = entry.partition("=")
+        if name in AGENT_ENV_KEYS:
+            environment[name] = value
+
+    down_at = time.monotonic()
+    old.stop(timeout=10)
+    old.remove()
+    try:
+        container = run_agent_container(image, agent_id, container_name, network_name, environment)
+        up_at = wait_until_started(container)
+        result = {"status": "updated", "image": image}
+    except Exception as e:
+        # Bring the agent back on its previous image before reporting failure
+        try:
+            docker_client.containers.get(container_name).remove(force=True)
+        except docker.errors.NotFound:
+            pass
+        container = run_agent_container(old_image, agent_id, container_name, network_name, environment)
+        up_at = time.monotonic()
+        result = {"status": "rolled_back", "image": old_image, "error": str(e)}
+
+    result["previous_image"] = old_image
+    result["downtime_seconds"] = round(up_at - down_at, 2)
+    redis_client.hset(agent_key(agent_id), mapping={
+        "container_id": container.id,
+        "image": result["image"]
+    })
+    return result
+
+
+def run_wave(pool, images):
+    """Recreate agents in parallel ({agent_id: image}) and return their results"""
+    futures = {agent_id: pool.submit(recreate_agent, agent_id, image) for agent_id, image in images.items()}
+    results = {}
+    for agent_id, future in futures.items():
+        try:
+            results[agent_id] = future.result()
+        except Exception as e:
+            results[agent_id] = {"status": "failed", "error": str(e)}
+    return results
+
+
+def pull_image(image):
+    """
+    Pull `image` on the local daemon and, in parallel, on DOCKER_NODES.
+    Agents run locally, so only the local pull must succeed; returns
+    {node base URL: error} for the extra nodes that failed.
+    """
+    def pull_on_node(url):
+        try:
+            docker.DockerClient(base_url=url, timeout=DOCKER_TIMEOUT).images.pull(image)
+        except Exception as e:
+            return str(e)
+
+    with ThreadPoolExecutor(max_workers=len(DOCKER_NODES) + 1) as pool:
+        node_pulls = {url: pool.submit(pull_on_node, url) for url in DOCKER_NODES}
+        docker_client.images.pull(image)
+        errors = {url: future.result() for url, future in node_pulls.items()}
+    return {url: error for url, error in errors.items() if error}
+
+
+def hold_rollout_lock(rollout_id, done):
+    """Refresh the active-rollout lock until `done` is set"""
+    while not done.wait(ROLLOUT_LOCK_TTL / 3):
+        try:
+            ROLLOUT_LOCK_SCRIPT(keys=[ACTIVE_ROLLOUT_KEY], args=[rollout_id, ROLLOUT_LOCK_TTL])
+        except REDIS_UNAVAILABLE_ERRORS as e:
+            app.logger.warning("Could not refresh rollout lock %s: %s", ACTIVE_ROLLOUT_KEY, e)
+
+
+def run_rollout(rollout_id, image, agent_ids, wave_size, max_failure_rate):
+    """
+    Background worker: pre-pull `image` everywhere, then recreate agents in
+    waves. If the failure rate crosses `max_failure_rate`, agents already
+    updated are reverted to their previous image so the fleet is not left mixed.
+    """
+    key = rollout_key(rollout_id)
+    started = time.monotonic()
+    downtimes = {}  # agent_id -> total downtime this rollout caused
+    done = threading.Event()
+    threading.Thread(target=hold_rollout_lock, args=(rollout_id, done), daemon=True).start()
+
+    def record(agent_id, result):
+        if "downtime_seconds" in result:
+            downtimes[agent_id] = round(downtimes.get(agent_id, 0) + result["downtime_seconds"], 2)
+            result["downtime_seconds"] = downtimes[agent_id]
+        redis_client.hset(rollout_agents_key(rollout_id), agent_id, json.dumps(result))
+
+    def finish(status, **fields):
+        if downtimes:
+            fields["avg_downtime_seconds"] = round(sum(downtimes.values()) / len(downtimes), 2)
+            fields["max_downtime_seconds"] = max(downtimes.values())
+        redis_client.hset(key, mapping={
+            "status": status,
+            "finished_at": datetime.utcnow().isoformat(),
+            "total_seconds": round(time.monotonic() - started, 1),
+            **fields
+        })
+
+    try:
+        redis_client.hset(key, "status", "pulling")
+        pull_errors = pull_image(image)
+        if pull_errors:
+            app.logger.warning("Rollout %s: pre-pull failed on %s", rollout_id, ", ".join(pull_errors))
+            redis_client.hset(key, "pull_errors", json.dumps(pull_errors))
+
+        redis_client.hset(key, "status", "rolling")
+        updated = {}
+        succeeded = failed = 0
+        with ThreadPoolExecutor(max_workers=wave_size) as pool:
+            for wave_start in range(0, len(agent_ids), wave_size):
+                wave = agent_ids[wave_start:wave_start + wave_size]
+                redis_client.hset(key, "current_wave", wave_start // wave_size + 1)
+
+                for agent_id, result in run_wave(pool, dict.fromkeys(wave, image)).items():
+                    record(agent_id, result)
+                    if result["status"] == "updated":
+                        updated[agent_id] = result["previous_image"]
+                        succeeded += 1
+                    else:
+                        failed += 1
+
+                redis_client.hset(key, mapping={"succeeded": succeeded, "failed": failed})
+                if failed / (succeeded + failed) > max_failure_rate:
+                    redis_client.hset(key, "status", "reverting")
+                    reverted = 0
+                    revert_ids = list(updated)
+                    for revert_start in range(0, len(revert_ids), wave_size):
+                        revert_wave = revert_ids[revert_start:revert_start + wave_size]
+                        results = run_wave(pool, {agent_id: updated[agent_id] for agent_id in revert_wave})
+                        for agent_id, result in results.items():
+                            if result["status"] == "updated":
+                                reverted += 1
+                                result["status"] = "reverted"
+                            else:
+                                result["status"] = "revert_failed"
+                            record(agent_id, result)
+                    finish(
+                        "halted",
+                        reverted=reverted,
+                        message=f"Failure rate exceeded {max_failure_rate:.0%}; "
+                                f"reverted {reverted}/{len(revert_ids)} updated agents"
+                    )
+                    return
+
+        redis_client.set(FLEET_IMAGE_KEY, image)
+        finish("completed")
+
+    except Exception as e:
+        finish("failed", message=str(e))
+
+    finally:
+        # Release the rollout lock even if recording the outcome failed
+        done.set()
+        try:
+            ROLLOUT_LOCK_SCRIPT(keys=[ACTIVE_ROLLOUT_KEY], args=[rollout_id, 0])
+        except REDIS_UNAVAILABLE_ERRORS as e:
+            app.logger.error("Could not release rollout lock %s: %s", ACTIVE_ROLLOUT_KEY, e)
+
+
+@app.route("/api/rollouts", methods=["POST"])
+@require_auth
+@slow_path
+def start_rollout():
+    """
+    Roll a new image out to every running agent
+    Body: {"image": ..., "wave_size": 5, "max_failure_rate": 0.2}
+    """
+    data = request.json or {}
+    image = data.get("image")
+    try:
+        wave_size = int(data.get("wave_size", 5))
+        max_failure_rate = float(data.get("max_failure_rate", 0.2))
+    except (TypeError, ValueError):
+        return jsonify({"error": "wave_size must be an integer and max_failure_rate a number"}), 400
+
+    if not image:
+        return jsonify({"error": "image required"}), 400
+    if not 1 <= wave_size <= MAX_ROLLOUT_WAVE_SIZE:
+        return jsonify({"error": f"wave_size must be between 1 and {MAX_ROLLOUT_WAVE_SIZE}"}), 400
+    if not 0 <= max_failure_rate <= 1:
+        return jsonify({"error": "max_failure_rate must be between 0 and 1"}), 400
+
+    rollout_id = str(uuid.uuid4())
+    if not request_redis().set(ACTIVE_ROLLOUT_KEY, rollout_id, nx=True, ex=ROLLOUT_LOCK_TTL):
+        active = request_redis().get(ACTIVE_ROLLOUT_KEY)
+        return jsonify({
+            "error": "A rollout is already in progress",
+            "rollout_id": active.decode() if active else None
+        }), 409
+
+    agent_ids = []
+    for agent_hash_key in request_redis().scan_iter(match="agent:*"):
+        if request_redis().hget(agent_hash_key, "status") == b"running":
+            agent_ids.append(agent_hash_key.decode().split(":", 1)[1])
+
+    request_redis().hset(rollout_key(rollout_id), mapping={
+        "image": image,
+        "status": "pending",
+        "total": len(agent_ids),
+        "succeeded": 0,
+        "failed": 0,
+        "wave_size": wave_size,
+        "max_failure_rate": max_failure_rate,
+        "started_at": datetime.utcnow().isoformat()
+    })
+
+    threading.Thread(
+        target=run_rollout,
+        args=(rollout_id, image, agent_ids, wave_size, max_failure_rate),
+        daemon=True
+    ).start()
+
+    return jsonify({
+        "success": True,
+        "rollout_id": rollout_id,
+        "image": image,
+        "total": len(agent_ids)
+    }), 202
+
+
+@app.route("/api/rollouts/<rollout_id>", methods=["GET"])
+@require_auth
+@batch_path
+def get_rollout(rollout_id):
+    """
+    Get rollout progress, per-agent results and downtime
+    A rollout whose worker died (e.g. orchestrator restart) without finishing
+    is reported as "abandoned" once its lock has expired.
+    """
+    info = request_redis(read_from_replicas=True).hgetall(rollout_key(rollout_id))
+    if not info:
+        return jsonify({"error": "Rollout not found"}), 404
+    if info[b"status"].decode() not in ROLLOUT_FINAL_STATUSES:
+        active = request_redis().get(ACTIVE_ROLLOUT_KEY)
+        if active is None or active.decode() != rollout_id:
+            # The replica may have missed the final status; ask the primary
+            info = request_redis().hgetall(rollout_key(rollout_id))
+            if info[b"status"].decode() not in ROLLOUT_FINAL_STATUSES:
+                info[b"status"] = b"abandoned"
+
+    agents = {
+        agent_id.decode(): json.loads(result)
+        for agent_id, result in request_redis(read_from_replicas=True).hgetall(rollout_agents_key(rollout_id)).items()
+    }
+
+    return jsonify({
+        "rollout_id": rollout_id,
+        **{field.decode(): value.decode() for field, value in info.items()},
+        "agents": agents
+    })
+
+
 @app.route("/api/credits/check", methods=["POST"])
 @require_auth
+@fast_path
+@billing_check
 def check_credits():
     """
     Check if user has sufficient credits before an API call
@@ -333,8 +1160,8 @@ def check_credits():
         return jsonify({"error": "user_id required"}), 400
 
     # Get balance from Redis cache
-    balance_key = f"credits:{user_id}"
-    balance = redis_client.get(balance_key)
+    balance_key = credits_key(user_id)
+    balance = request_redis().get(balance_key)
 
     if balance is None:
         # If not in cache, assume they have credits (will be verified by main DB)
@@ -360,32 +1187,58 @@ def check_credits():
 
 @app.route("/api/credits/deduct", methods=["POST"])
 @require_auth
+@fast_path
 def deduct_credits():
     """
     Deduct credits after an API call completes
-    Called by LiteLLM callback
+    Called by LiteLLM callback. With a charge_id (e.g. the LiteLLM call id)
+    the deduction is idempotent, so the callback can safely retry it.
     """
     data = request.json
     user_id = data.get("user_id")
+    agent_id = data.get("agent_id")
+    charge_id = data.get("charge_id")
     cost_cents = data.get("cost_cents", 0)
 
     if not user_id:
         return jsonify({"error": "user_id required"}), 400
 
-    balance_key = f"credits:{user_id}"
+    balance_key = credits_key(user_id)
+
+    try:
+        if charge_id:
+            applied, new_balance = DEDUCT_SCRIPT(
+                keys=[balance_key, charge_key(user_id, charge_id)],
+                args=[cost_cents, CHARGE_DEDUPE_TTL],
+                client=request_redis()
+            )
+        else:
+            # Atomic decrement
+            applied, new_balance = 1, request_redis().decrby(balance_key, cost_cents)
+    except REDIS_UNAVAILABLE_ERRORS as e:
+        note_billing_redis_failure(e)
+        # A timeout may hide an applied deduction, so only invite a retry
+        # when the charge_id makes it idempotent
+        if charge_id:
+            return jsonify({"error": f"Billing store unavailable: {e}"}), 503, {"Retry-After": "1"}
+        return jsonify({
+            "error": f"Billing store unavailable, deduction outcome unknown: {e}"
+        }), 504
 
-    # Atomic decrement
-    new_balance = redis_client.decrby(balance_key, cost_cents)
+    if applied:
+        record_usage(user_id, agent_id, cents=cost_cents, calls=1)
 
     return jsonify({
         "success": True,
         "new_balance_cents": new_balance,
-        "deducted_cents": cost_cents
+        "deducted_cents": cost_cents if applied else 0,
+        "duplicate": not applied
     })
 
 
 @app.route("/api/credits/set", methods=["POST"])
 @require_auth
+@fast_path
 def set_credits():
     """
     Set credit balance for a user (used to sync from main DB)
@@ -397,8 +1250,8 @@ def set_credits():
     if not user_id:
         return jsonify({"error": "user_id required"}), 400
 
-    balance_key = f"credits:{user_id}"
-    redis_client.set(balance_key, balance_cents)
+    balance_key = credits_key(user_id)
+    request_redis().set(balance_key, balance_cents)
 
     return jsonify({
         "success": True,
@@ -407,26 +1260,59 @@ def set_credits():
     })
 
 
+@app.route("/api/credits/set-bulk", methods=["POST"])
+@require_auth
+@batch_path
+def set_credits_bulk():
+    """
+    Set credit balances for many users at once (hourly sync from main DB)
+    Body: {"balances": [{"user_id": ..., "balance_cents": ...}, ...]}
+    In cluster mode the pipeline is split per node and sent in parallel.
+    """
+    data = request.json or {}
+    balances = data.get("balances", [])
+
+    if not isinstance(balances, list):
+        return jsonify({"error": "balances must be a list"}), 400
+    for entry in balances:
+        if not isinstance(entry, dict) or not entry.get("user_id"):
+            return jsonify({"error": "user_id required for every entry"}), 400
+        balance_cents = entry.get("balance_cents", 0)
+        if not isinstance(balance_cents, int) or isinstance(balance_cents, bool):
+            return jsonify({"error": f"balance_cents must be an integer for {entry['user_id']}"}), 400
+
+    pipe = request_redis().pipeline(transaction=False)
+    for entry in balances:
+        pipe.set(credits_key(entry["user_id"]), entry.get("balance_cents", 0))
+    pipe.execute()
+
+    return jsonify({
+        "success": True,
+        "updated": len(balances)
+    })
+
+
 @app.route("/api/rate-limit/check", methods=["POST"])
 @require_auth
+@fast_path
+@billing_check
 def check_rate_limit():
     """
     Check hourly rate limit (200K tokens per hour per user)
     """
     data = request.json
     user_id = data.get("user_id")
+    agent_id = data.get("agent_id")
     tokens = data.get("tokens", 0)
 
     if not user_id:
         return jsonify({"error": "user_id required"}), 400
 
     # Sliding window rate limit key
-    rate_key = f"rate:{user_id}:hourly"
-    current = redis_client.get(rate_key)
+    hourly_key = rate_key(user_id)
+    current = request_redis().get(hourly_key)
     current_tokens = int(current) if current else 0
 
-    HOURLY_LIMIT = 200000  # 200K tokens per hour
-
     if current_tokens + tokens > HOURLY_LIMIT:
         return jsonify({
             "allowed": False,
@@ -437,10 +1323,11 @@ def check_rate_limit():
         })
 
     # Increment counter with 1 hour TTL
-    pipe = redis_client.pipeline()
-    pipe.incrby(rate_key, tokens)
-    pipe.expire(rate_key, 3600)  # 1 hour
+    pipe = request_redis().pipeline()
+    pipe.incrby(hourly_key, tokens)
+    pipe.expire(hourly_key, 3600)  # 1 hour
     pipe.execute()
+    record_usage(user_id, agent_id, tokens=tokens)
 
     return jsonify({
         "allowed": True,
@@ -449,8 +1336,116 @@ def check_rate_limit():
     })
 
 
+@app.route("/api/usage/check", methods=["POST"])
+@require_auth
+@fast_path
+@billing_check
+def check_usage():
+    """
+    Combined credit + rate limit check in a single atomic Redis round trip
+    Used by LiteLLM as a pre-call hook instead of calling
+    /api/credits/check and /api/rate-limit/check separately
+    """
+    data = request.json
+    user_id = data.get("user_id")
+    agent_id = data.get("agent_id")
+    estimated_cost = data.get("estimated_cost", 0.01)  # Default 1 cent
+    tokens = data.get("tokens", 0)
+
+    if not user_id:
+        return jsonify({"error": "user_id required"}), 400
+
+    estimated_cents = int(estimated_cost * 100)
+    allowed, reason, cached, balance_cents, current_tokens = USAGE_CHECK_SCRIPT(
+        keys=[credits_key(user_id), rate_key(user_id)],
+        args=[estimated_cents, tokens, HOURLY_LIMIT, 3600],
+        client=request_redis()
+    )
+
+    result = {
+        "allowed": bool(allowed),
+        "balance_cents": balance_cents if cached else "unknown",
+        "estimated_cents": estimated_cents,
+        "current_tokens": current_tokens,
+        "limit": HOURLY_LIMIT
+    }
+    if allowed:
+        record_usage(user_id, agent_id, tokens=tokens)
+    else:
+        result["reason"] = reason.decode()
+        result["message"] = (
+            "Insufficient credits" if result["reason"] == "insufficient_credits"
+            else "Rate limit exceeded. Please wait."
+        )
+
+    return jsonify(result)
+
+
+@app.route("/api/usage/rollups", methods=["GET"])
+@require_auth
+@batch_path
+def get_usage_rollups():
+    """
+    Range query over precomputed usage rollups for dashboards
+    Query: user_id or agent_id, resolution (minute|hour|day),
+    optional start/end as unix timestamps (default: last 60 buckets)
+    """
+    user_id = request.args.get("user_id")
+    agent_id = request.args.get("agent_id")
+    resolution = request.args.get("resolution", "hour")
+
+    if not user_id and not agent_id:
+        return jsonify({"error": "user_id or agent_id required"}), 400
+    if resolution not in ROLLUP_RESOLUTIONS:
+        return jsonify({"error": f"resolution must be one of {', '.join(ROLLUP_RESOLUTIONS)}"}), 400
+
+    size, retention = ROLLUP_RESOLUTIONS[resolution]
+    now = int(time.time())
+    try:
+        end = int(request.args.get("end", now))
+        start = int(request.args.get("start", end - 59 * size))
+    except ValueError:
+        return jsonify({"error": "start and end must be unix timestamps"}), 400
+
+    if end < start:
+        return jsonify({"error": "end must not be before start"}), 400
+
+    # Buckets older than the retention window have already expired, so a
+    # range lying wholly in expired history comes back empty
+    start = max(start, now - retention)
+    start -= start % size
+    end -= end % size
+    if (end - start) // size + 1 > ROLLUP_MAX_BUCKETS:
+        return jsonify({"error": f"range exceeds {ROLLUP_MAX_BUCKETS} buckets"}), 400
+
+    scope, scope_id = ("agent", agent_id) if agent_id else ("user", user_id)
+    bucket_starts = list(range(start, end + 1, size))
+
+    pipe = request_redis(read_from_replicas=True).pipeline(transaction=False)
+    for bucket_start in bucket_starts:
+        pipe.hmget(rollup_key(scope, scope_id, resolution, bucket_start), *ROLLUP_FIELDS)
+
+    buckets = []
+    totals = dict.fromkeys(ROLLUP_FIELDS, 0)
+    for bucket_start, values in zip(bucket_starts, pipe.execute()):
+        bucket = {"start": bucket_start}
+        for field, value in zip(ROLLUP_FIELDS, values):
+            bucket[field] = int(value) if value else 0
+            totals[field] += bucket[field]
+        buckets.append(bucket)
+
+    return jsonify({
+        scope + "_id": scope_id,
+        "resolution": resolution,
+        "bucket_seconds": size,
+        "buckets": buckets,
+        "totals": totals
+    })
+
+
 @app.route("/api/test-litellm", methods=["POST"])
 @require_auth
+@slow_path
 def test_litellm():
     """
     Test LiteLLM connectivity and API functionality
@@ -471,7 +1466,7 @@ def test_litellm():
                 "messages": [{"role": "user", "content": message}],
                 "max_tokens": 150
             },
-            timeout=60
+            timeout=time_left(60)
         )
 
         if response.status_code == 200:
@@ -495,6 +1490,7 @@ def test_litellm():
 
 @app.route("/api/services/whatsapp-bridge/deploy", methods=["POST"])
 @require_auth
+@build_path
 def deploy_whatsapp_bridge():
     """
     Deploy the WhatsApp bridge service
@@ -505,7 +1501,7 @@ def deploy_whatsapp_bridge():
     try:
         # Check if container already exists
         try:
-            existing = docker_client.containers.get(container_name)
+            existing = request_docker().containers.get(container_name)
             if existing.status == "running":
                 return jsonify({
                     "success": True,
@@ -674,14 +1670,14 @@ CMD ["node", "index.js"]
                 f.write(dockerfile)
 
         # Build the Docker image
-        image, build_logs = docker_client.images.build(
+        image, build_logs = request_docker(DOCKER_BUILD_TIMEOUT).images.build(
             path=whatsapp_dir,
             tag="theone/whatsapp-bridge:latest",
             rm=True
         )
 
         # Run the container
-        container = docker_client.containers.run(
+        container = request_docker().containers.run(
             "theone/whatsapp-bridge:latest",
             name=container_name,
             detach=True,
@@ -697,7 +1693,7 @@ CMD ["node", "index.js"]
 
         # Connect to theone network
         try:
-            theone_network = docker_client.networks.get("theone_theone-network")
+            theone_network = request_docker().networks.get("theone_theone-network")
             theone_network.connect(container)
         except Exception:
             pass  # Network might not exist yet
@@ -715,10 +1711,11 @@ CMD ["node", "index.js"]
 
 
 @app.route("/api/services/whatsapp-bridge/status", methods=["GET"])
+@slow_path
 def whatsapp_bridge_status():
     """Check WhatsApp bridge service status"""
     try:
-        container = docker_client.containers.get("whatsapp-bridge")
+        container = request_docker().containers.get("whatsapp-bridge")
         return jsonify({
             "running": container.status == "running",
             "status": container.status,
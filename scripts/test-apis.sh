@@ -61,7 +61,53 @@ else
     fail "LiteLLM integration"
 fi
 
-# Test 5: WhatsApp Bridge Health (direct check)
+# Test 5: Combined credit + rate limit check (single-slot Lua script, works on Redis Cluster)
+curl -s -X POST "$ORCHESTRATOR_URL/api/credits/set" \
+    -H "Authorization: Bearer $ORCH_SECRET" \
+    -H "Content-Type: application/json" \
+    -d '{"user_id":"test-apis-user","balance_cents":500}' > /dev/null 2>&1
+result=$(curl -s -X POST "$ORCHESTRATOR_URL/api/usage/check" \
+    -H "Authorization: Bearer $ORCH_SECRET" \
+    -H "Content-Type: application/json" \
+    -d '{"user_id":"test-apis-user","estimated_cost":0.01,"tokens":10}' 2>/dev/null)
+if echo "$result" | grep -q '"allowed": *true'; then
+    pass "Credit + rate limit check"
+else
+    fail "Credit + rate limit check"
+fi
+
+# Test 6: Usage rollups range query
+result=$(curl -s "$ORCHESTRATOR_URL/api/usage/rollups?user_id=test-apis-user&resolution=minute" \
+    -H "Authorization: Bearer $ORCH_SECRET" 2>/dev/null)
+if echo "$result" | grep -q '"buckets"'; then
+    pass "Usage rollups query"
+else
+    fail "Usage rollups query"
+fi
+
+# Test 7: Request pool metrics
+result=$(curl -s "$ORCHESTRATOR_URL/api/metrics" \
+    -H "Authorization: Bearer $ORCH_SECRET" 2>/dev/null)
+if echo "$result" | grep -q '"pools"' && echo "$result" | grep -q '"billing_failure_policy"'; then
+    pass "Request pool metrics"
+else
+    fail "Request pool metrics"
+fi
+
+# Test 8: Rollout API input handling (no rollout is started)
+status=$(curl -s -o /dev/null -w "%{http_code}" "$ORCHESTRATOR_URL/api/rollouts/test-apis-missing-rollout" \
+    -H "Authorization: Bearer $ORCH_SECRET" 2>/dev/null)
+invalid=$(curl -s -o /dev/null -w "%{http_code}" -X POST "$ORCHESTRATOR_URL/api/rollouts" \
+    -H "Authorization: Bearer $ORCH_SECRET" \
+    -H "Content-Type: application/json" \
+    -d '{"image":"test-apis:invalid","wave_size":0}' 2>/dev/null)
+if [ "$status" = "404" ] && [ "$invalid" = "400" ]; then
+    pass "Rollout API"
+else
+    fail "Rollout API (unknown id: $status, invalid wave_size: $invalid)"
+fi
+
+# Test 9: WhatsApp Bridge Health (direct check)
 WHATSAPP_BRIDGE_URL="${WHATSAPP_BRIDGE_URL:-http://46.225.107.94:3001}"
 result=$(curl -s "$WHATSAPP_BRIDGE_URL/health" 2>/dev/null)
 if echo "$result" | grep -q '"status":"ok"'; then
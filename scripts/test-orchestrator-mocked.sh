@@ -0,0 +1,231 @@
+#!/bin/bash
+# Orchestrator checks against a mocked Docker daemon
+# Starts a throwaway standalone Redis, replaces the Docker SDK clients with
+# mocks and exercises the request pools: load shedding (503 + Retry-After),
+# request deadlines (504), the billing failure policy, /api/metrics and
+# image rollouts (lock refresh, downtime, node pull errors, halt + revert).
+# Needs redis-server on PATH and the orchestrator's Python deps; no Docker
+# daemon required.
+# Run: bash scripts/test-orchestrator-mocked.sh
+
+set -e
+
+REDIS_PORT="${REDIS_PORT:-7100}"
+ROOT_DIR="$(cd "$(dirname "$0")/.." && pwd)"
+WORK_DIR="$(mktemp -d)"
+
+cleanup() {
+    if [ -f "$WORK_DIR/redis.pid" ]; then
+        kill "$(cat "$WORK_DIR/redis.pid")" 2>/dev/null || true
+    fi
+    rm -rf "$WORK_DIR"
+}
+trap cleanup EXIT
+
+echo "=== The One - Orchestrator Check (mocked Docker) ==="
+
+redis-server --port "$REDIS_PORT" --dir "$WORK_DIR" --pidfile "$WORK_DIR/redis.pid" \
+    --appendonly no --save "" --daemonize yes
+
+REDIS_PORT="$REDIS_PORT" ORCHESTRATOR_APP="$ROOT_DIR/hetzner-setup/orchestrator-app.py" python3 - << 'PYCHECK'
+import importlib.util
+import json
+import os
+import sys
+import threading
+import time
+from unittest import mock
+
+import docker
+import redis
+
+GREEN, RED, NC = "\033[0;32m", "\033[0;31m", "\033[0m"
+failures = 0
+
+
+def check(name, ok):
+    global failures
+    if ok:
+        print(f"{GREEN}✓ PASS{NC}: {name}")
+    else:
+        failures += 1
+        print(f"{RED}✗ FAIL{NC}: {name}")
+
+
+port = int(os.environ["REDIS_PORT"])
+store = redis.Redis(port=port)
+for _ in range(50):
+    try:
+        store.ping()
+        break
+    except redis.ConnectionError:
+        time.sleep(0.1)
+else:
+    sys.exit("Redis did not start")
+
+# Every Docker client the orchestrator builds is this one mock
+fake_docker = mock.MagicMock()
+mock.patch("docker.from_env", return_value=fake_docker).start()
+mock.patch("docker.DockerClient", return_value=fake_docker).start()
+
+
+def load_orchestrator(name, **env):
+    with mock.patch.dict(os.environ, env):
+        spec = importlib.util.spec_from_file_location(name, os.environ["ORCHESTRATOR_APP"])
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    return module
+
+
+common = {
+    "REDIS_URL": f"redis://127.0.0.1:{port}",
+    "SLOW_POOL_LIMIT": "1",
+    "SLOW_POOL_MAX_QUEUE": "0",
+    "AGENT_START_GRACE": "2",
+    "ROLLOUT_LOCK_TTL": "2"
+}
+orchestrator = load_orchestrator("orchestrator", BILLING_FAILURE_POLICY="open", **common)
+client = orchestrator.app.test_client()
+auth = {"Authorization": f"Bearer {orchestrator.API_SECRET}"}
+
+# --- Load shedding: a second slow request while the only slot is busy ---
+store.hset(orchestrator.agent_key("busy-agent"), mapping={"status": "running", "container_name": "agent_busy"})
+entered, release = threading.Event(), threading.Event()
+
+
+def blocking_get(name):
+    entered.set()
+    release.wait(5)
+    return mock.MagicMock(status="running")
+
+
+fake_docker.containers.get.side_effect = blocking_get
+holder = threading.Thread(target=lambda: client.get("/api/agents/busy-agent/status", headers=auth))
+holder.start()
+entered.wait(5)
+resp = client.get("/api/agents/busy-agent/status", headers=auth)
+check("Busy slow pool sheds with 503 and Retry-After",
+      resp.status_code == 503 and resp.headers.get("Retry-After") == str(orchestrator.slow_path.retry_after))
+resp = client.post("/api/credits/check", headers=auth, json={"user_id": "u1"})
+check("Fast pool unaffected by a busy slow pool", resp.status_code == 200)
+release.set()
+holder.join()
+
+stats = client.get("/api/metrics", headers=auth).get_json()
+check("Metrics report shed and completed requests",
+      stats["pools"]["slow"]["shed"] == 1 and stats["pools"]["slow"]["completed"] >= 1
+      and stats["pools"]["slow"]["in_flight"] == 0)
+
+# --- Deadlines: a Docker step after the deadline has passed ---
+store.hset(orchestrator.agent_key("slow-agent"), mapping={"status": "running", "container_name": "agent_slow"})
+container = mock.MagicMock()
+fake_docker.containers.get.side_effect = lambda name: time.sleep(0.3) or container
+with mock.patch.object(orchestrator.slow_path, "deadline", 0.2):
+    resp = client.post("/api/agents/slow-agent/deprovision", headers=auth)
+check("Request past its deadline gets 504", resp.status_code == 504)
+check("No Docker step runs after the deadline", not container.stop.called)
+fake_docker.containers.get.side_effect = None
+
+# --- Billing failure policy with Redis down ---
+def billing_with_redis_down(module):
+    test_client = module.app.test_client()
+    error = redis.exceptions.ConnectionError("Redis down")
+    with mock.patch.object(module, "redis_with_timeout", side_effect=error):
+        return [
+            test_client.post("/api/credits/check", headers=auth, json={"user_id": "u1"}).get_json(),
+            test_client.post("/api/rate-limit/check", headers=auth, json={"user_id": "u1", "tokens": 10}).get_json(),
+            test_client.post("/api/usage/check", headers=auth, json={"user_id": "u1"}).get_json()
+        ]
+
+
+responses = billing_with_redis_down(orchestrator)
+check("Fail-open policy allows calls while Redis is down",
+      all(r["allowed"] is True and r["degraded"] is True for r in responses))
+check("Billing Redis failures counted in metrics",
+      client.get("/api/metrics", headers=auth).get_json()["billing_redis_failures"] == 3)
+
+closed = load_orchestrator("orchestrator_closed", BILLING_FAILURE_POLICY="closed", **common)
+responses = billing_with_redis_down(closed)
+check("Fail-closed policy blocks calls while Redis is down",
+      all(r["allowed"] is False and r["degraded"] is True for r in responses))
+
+error = redis.exceptions.ClusterDownError("CLUSTERDOWN")
+with mock.patch.object(orchestrator, "redis_with_timeout", side_effect=error):
+    resp = client.post("/api/credits/check", headers=auth, json={"user_id": "u1"})
+check("Cluster errors follow the billing failure policy", resp.status_code == 200 and resp.get_json()["allowed"])
+
+try:
+    load_orchestrator("orchestrator_invalid", BILLING_FAILURE_POLICY="sometimes", **common)
+    check("Invalid billing failure policy rejected at startup", False)
+except ValueError:
+    check("Invalid billing failure policy rejected at startup", True)
+
+# --- Rollouts ---
+store.flushdb()
+agent_ids = [f"a{i}" for i in range(1, 7)]
+for agent_id in agent_ids:
+    store.hset(orchestrator.agent_key(agent_id), mapping={
+        "status": "running", "container_name": f"agent_{agent_id}", "network_name": f"net_{agent_id}"
+    })
+bad_image = {}  # container name -> image that exits on start
+
+
+def fake_get(name):
+    return mock.MagicMock(attrs={"Config": {"Image": "agent:v1", "Env": ["AGENT_ID=x"]}})
+
+
+def fake_run(image, name, **kwargs):
+    if bad_image.get(name) == image:
+        return mock.MagicMock(id=f"{name}-{image}", status="exited", attrs={"State": {"ExitCode": 1}})
+    return mock.MagicMock(id=f"{name}-{image}", status="running", attrs={"State": {}, "RestartCount": 0})
+
+
+def wait_for_rollout(rollout_id):
+    for _ in range(300):
+        info = client.get(f"/api/rollouts/{rollout_id}", headers=auth).get_json()
+        if info["status"] in orchestrator.ROLLOUT_FINAL_STATUSES:
+            return info
+        time.sleep(0.1)
+    return info
+
+
+fake_docker.containers.get.side_effect = fake_get
+fake_docker.containers.run.side_effect = fake_run
+
+resp = client.post("/api/rollouts", headers=auth, json={"image": "agent:v2", "wave_size": 1000})
+check("Rollout rejects oversized waves", resp.status_code == 400)
+
+node = "tcp://unreachable-node:2375"
+with mock.patch.object(orchestrator, "DOCKER_NODES", [node]), \
+        mock.patch("docker.DockerClient", side_effect=docker.errors.DockerException("unreachable")):
+    rollout_id = client.post("/api/rollouts", headers=auth, json={
+        "image": "agent:v2", "wave_size": 2, "max_failure_rate": 0.2
+    }).get_json()["rollout_id"]
+    time.sleep(3)  # past the lock's initial TTL
+    check("Rollout lock refreshed while the worker runs",
+          store.get(orchestrator.ACTIVE_ROLLOUT_KEY) == rollout_id.encode())
+    info = wait_for_rollout(rollout_id)
+check("Rollout completes despite an unreachable extra node",
+      info["status"] == "completed" and node in json.loads(info.get("pull_errors", "{}")))
+check("Rollout downtime excludes the start grace period",
+      all(result["downtime_seconds"] < orchestrator.AGENT_START_GRACE for result in info["agents"].values()))
+check("Fleet image recorded after rollout", store.get(orchestrator.FLEET_IMAGE_KEY) == b"agent:v2")
+check("Rollout lock released", not store.exists(orchestrator.ACTIVE_ROLLOUT_KEY))
+
+bad_image["agent_a3"] = "agent:v3"
+rollout_id = client.post("/api/rollouts", headers=auth, json={
+    "image": "agent:v3", "wave_size": 2, "max_failure_rate": 0.2
+}).get_json()["rollout_id"]
+info = wait_for_rollout(rollout_id)
+others = [result["status"] for agent_id, result in info["agents"].items() if agent_id != "a3"]
+check("Failing rollout halts", info["status"] == "halted" and info["agents"]["a3"]["status"] == "rolled_back")
+check("Halted rollout reverts updated agents",
+      others and all(status == "reverted" for status in others) and info["reverted"] == str(len(others)))
+check("Halted rollout leaves the fleet image alone", store.get(orchestrator.FLEET_IMAGE_KEY) == b"agent:v2")
+
+store.hset(orchestrator.rollout_key("dead-rollout"), mapping={"status": "rolling", "image": "agent:v4"})
+info = client.get("/api/rollouts/dead-rollout", headers=auth).get_json()
+check("Rollout without a live worker reported abandoned", info["status"] == "abandoned")
+
+sys.exit(1 if failures else 0)
+PYCHECK
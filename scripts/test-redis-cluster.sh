@@ -0,0 +1,186 @@
+#!/bin/bash
+# Redis Cluster check for the orchestrator
+# Starts a local 6-node cluster (3 primaries + 3 replicas), points the
+# orchestrator at it with REDIS_CLUSTER=true and exercises the cluster paths:
+# legacy key migration, the credit + rate Lua check, idempotent deductions,
+# the bulk credit pipeline and replica reads.
+# Needs redis-server on PATH, the orchestrator's Python deps and a reachable
+# Docker daemon (the orchestrator connects to Docker on import).
+# Run: bash scripts/test-redis-cluster.sh
+
+set -e
+
+BASE_PORT="${BASE_PORT:-7000}"
+ROOT_DIR="$(cd "$(dirname "$0")/.." && pwd)"
+WORK_DIR="$(mktemp -d)"
+PORTS=$(seq "$BASE_PORT" $((BASE_PORT + 5)))
+
+cleanup() {
+    for port in $PORTS; do
+        if [ -f "$WORK_DIR/$port/redis.pid" ]; then
+            kill "$(cat "$WORK_DIR/$port/redis.pid")" 2>/dev/null || true
+        fi
+    done
+    rm -rf "$WORK_DIR"
+}
+trap cleanup EXIT
+
+echo "=== The One - Redis Cluster Check ==="
+
+for port in $PORTS; do
+    mkdir -p "$WORK_DIR/$port"
+    redis-server --port "$port" --cluster-enabled yes \
+        --cluster-config-file "$WORK_DIR/$port/nodes.conf" \
+        --dir "$WORK_DIR/$port" --pidfile "$WORK_DIR/$port/redis.pid" \
+        --appendonly no --save "" --daemonize yes
+done
+
+BASE_PORT="$BASE_PORT" ORCHESTRATOR_APP="$ROOT_DIR/hetzner-setup/orchestrator-app.py" python3 - << 'PYCHECK'
+import importlib.util
+import os
+import sys
+import time
+
+import redis
+
+GREEN, RED, NC = "\033[0;32m", "\033[0;31m", "\033[0m"
+failures = 0
+
+
+def check(name, ok):
+    global failures
+    if ok:
+        print(f"{GREEN}✓ PASS{NC}: {name}")
+    else:
+        failures += 1
+        print(f"{RED}✗ FAIL{NC}: {name}")
+
+
+# --- Bootstrap the cluster: 3 primaries with a replica each ---
+base = int(os.environ["BASE_PORT"])
+nodes = [redis.Redis(port=base + i) for i in range(6)]
+for node in nodes:
+    for _ in range(50):
+        try:
+            node.ping()
+            break
+        except redis.ConnectionError:
+            time.sleep(0.1)
+
+for node in nodes[1:]:
+    node.execute_command("CLUSTER", "MEET", "127.0.0.1", base)
+ranges = [(0, 5460), (5461, 10922), (10923, 16383)]
+for node, (first, last) in zip(nodes[:3], ranges):
+    node.execute_command("CLUSTER", "ADDSLOTS", *range(first, last + 1))
+
+for _ in range(100):
+    if all(len(node.execute_command("CLUSTER", "NODES").splitlines()) == 6 for node in nodes):
+        break
+    time.sleep(0.1)
+for primary, replica in zip(nodes[:3], nodes[3:]):
+    replica.execute_command("CLUSTER", "REPLICATE", primary.execute_command("CLUSTER", "MYID"))
+
+for _ in range(200):
+    if all(b"cluster_state:ok" in node.execute_command("CLUSTER", "INFO") for node in nodes) \
+            and all(node.info("replication")["role"] == "slave" for node in nodes[3:]) \
+            and all(node.info("replication").get("master_link_status") == "up" for node in nodes[3:]) \
+            and all(len(slot_range) == 4 for node in nodes for slot_range in node.execute_command("CLUSTER", "SLOTS")):
+        break
+    time.sleep(0.1)
+else:
+    sys.exit("Cluster did not become ready")
+
+def load_orchestrator(name):
+    spec = importlib.util.spec_from_file_location(name, os.environ["ORCHESTRATOR_APP"])
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# --- The orchestrator must start even when the cluster is unreachable ---
+os.environ["REDIS_CLUSTER"] = "true"
+os.environ["REDIS_URL"] = f"redis://127.0.0.1:{base + 99}"
+try:
+    load_orchestrator("orchestrator_unreachable")
+    check("Orchestrator starts while the cluster is unreachable", True)
+except Exception as e:
+    check(f"Orchestrator starts while the cluster is unreachable ({e})", False)
+
+# --- Seed pre-hash-tag keys, then load the orchestrator against the cluster ---
+seed = redis.RedisCluster(host="127.0.0.1", port=base)
+seed.set("credits:legacy-user", 750)
+seed.set("rate:legacy-user:hourly", 1234, ex=3600)
+
+os.environ["REDIS_URL"] = f"redis://127.0.0.1:{base}"
+orchestrator = load_orchestrator("orchestrator")
+client = orchestrator.app.test_client()
+auth = {"Authorization": f"Bearer {orchestrator.API_SECRET}"}
+rc = orchestrator.redis_client
+
+# Legacy key migration
+check("Legacy credit balance moved to hash-tagged key",
+      rc.get(orchestrator.credits_key("legacy-user")) == b"750" and not rc.exists("credits:legacy-user"))
+check("Legacy rate counter moved with its TTL",
+      rc.get(orchestrator.rate_key("legacy-user")) == b"1234" and rc.ttl(orchestrator.rate_key("legacy-user")) > 0)
+
+# Per-user keys share a slot
+check("Credit and rate keys hash to the same slot",
+      rc.keyslot(orchestrator.credits_key("u1")) == rc.keyslot(orchestrator.rate_key("u1")))
+
+# Bulk credit sync spanning every primary
+users = [f"bulk-user-{i}" for i in range(200)]
+resp = client.post("/api/credits/set-bulk", headers=auth, json={
+    "balances": [{"user_id": user, "balance_cents": 100 + i} for i, user in enumerate(users)]
+})
+slots_nodes = {rc.get_node_from_key(orchestrator.credits_key(user)).name for user in users}
+check("Bulk credit pipeline covers all primaries", resp.status_code == 200 and len(slots_nodes) == 3)
+check("Bulk credit balances stored",
+      all(rc.get(orchestrator.credits_key(user)) == str(100 + i).encode() for i, user in enumerate(users)))
+resp = client.post("/api/credits/set-bulk", headers=auth, json={"balances": ["not-an-object"]})
+check("Bulk credit sync rejects malformed entries", resp.status_code == 400)
+
+# Combined credit + rate Lua check
+resp = client.post("/api/usage/check", headers=auth, json={
+    "user_id": "bulk-user-0", "estimated_cost": 0.5, "tokens": 100
+}).get_json()
+check("Usage check allows funded user", resp["allowed"] is True and resp["balance_cents"] == 100)
+check("Usage check incremented rate counter", rc.get(orchestrator.rate_key("bulk-user-0")) == b"100")
+
+client.post("/api/credits/set", headers=auth, json={"user_id": "overdrawn-user", "balance_cents": -40})
+resp = client.post("/api/usage/check", headers=auth, json={"user_id": "overdrawn-user"}).get_json()
+check("Usage check reports negative balance",
+      resp["allowed"] is False and resp["reason"] == "insufficient_credits" and resp["balance_cents"] == -40)
+
+resp = client.post("/api/usage/check", headers=auth, json={"user_id": "uncached-user"}).get_json()
+check("Usage check allows uncached user", resp["allowed"] is True and resp["balance_cents"] == "unknown")
+
+# Idempotent deduction (charge dedupe key shares the user's slot)
+charge = {"user_id": "bulk-user-1", "cost_cents": 30, "charge_id": "call-1"}
+first = client.post("/api/credits/deduct", headers=auth, json=charge).get_json()
+retry = client.post("/api/credits/deduct", headers=auth, json=charge).get_json()
+check("Deduction applied once per charge_id",
+      first["new_balance_cents"] == 71 and retry["duplicate"] is True
+      and rc.get(orchestrator.credits_key("bulk-user-1")) == b"71")
+
+# Replica reads
+def replica_reads():
+    return sum(node.info("commandstats").get("cmdstat_hgetall", {}).get("calls", 0) for node in nodes[3:])
+
+
+rc.hset(orchestrator.agent_key("replica-agent"), mapping={"status": "running"})
+time.sleep(0.5)  # let replication catch up
+before = replica_reads()
+for _ in range(10):
+    orchestrator.redis_with_timeout(1, read_from_replicas=True).hgetall(orchestrator.agent_key("replica-agent"))
+check("Status reads served by replicas", replica_reads() > before)
+
+rc.hset(orchestrator.agent_key("fresh-agent"), mapping={"status": "running", "container_name": "agent_fresh"})
+resp = client.get("/api/agents/fresh-agent/status", headers=auth)
+check("Status of a just-written agent falls back to the primary", resp.status_code != 404)
+
+time.sleep(0.5)  # rollups are read through the replica client too
+resp = client.get("/api/usage/rollups?user_id=bulk-user-0&resolution=minute", headers=auth).get_json()
+check("Usage rollups readable in cluster mode", resp["totals"]["tokens"] == 100)
+
+sys.exit(1 if failures else 0)
+PYCHECK